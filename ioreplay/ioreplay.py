@@ -13,21 +13,33 @@ import argparse
 import traceback
 from time import sleep
 from uuid import uuid4
-from pprint import pprint
+from array import array
 from functools import wraps
+from operator import itemgetter
 from contextlib import suppress
 from tempfile import TemporaryDirectory
-from itertools import tee, zip_longest, islice
+from itertools import islice, repeat
+from multiprocessing import Pool, freeze_support
 from typing import Optional, Tuple, Dict, Callable
-from collections import namedtuple, deque, OrderedDict, ChainMap
+from collections import namedtuple, deque, OrderedDict
 
+# Durations are measured using monotonic clock, which, unlike wall clock,
+# is not affected by system time adjustments made during replay
 try:
-    from time import time_ns
+    from time import monotonic_ns
 except ImportError:
-    from time import time as _time
+    from time import monotonic as _monotonic
 
-    def time_ns():
-        return int(_time() * 10**9)
+    def monotonic_ns():
+        return int(_monotonic() * 10**9)
+
+try:
+    from os import preadv
+except ImportError:
+    def preadv(fd, buffers, offset):
+        # Content of read buffers is never inspected so it is fine to read
+        # data into newly allocated bytes instead
+        return len(os.pread(fd, sum(len(buf) for buf in buffers), offset))
 
 
 # Max delay, in us, between subsequent fuse calls of the same system call
@@ -38,6 +50,19 @@ CTX_SWITCH_DELAY = 250
 # Number of lines read at ones as a chunk in external sort
 DEFAULT_CHUNK_SIZE = 50000
 
+# Size of buffers used for trace and chunk files during external sort, so
+# that they are transferred in few large syscalls instead of many 8KiB ones
+SORT_BUFFER_SIZE = 1 << 20
+
+# Replay pacing modes: 'real' reproduces recorded delays between syscalls,
+# 'max' issues syscalls one after another as fast as possible
+PACE_REAL = 'real'
+PACE_MAX = 'max'
+
+# Min delay, in ns, worth sleeping for. Shorter delays are accumulated until
+# they add up to it, as timer slack makes shorter sleeps last about as long.
+MIN_SLEEP_DELAY = 50000
+
 FUSE_SET_ATTR_MODE = (1 << 0)
 FUSE_SET_ATTR_SIZE = (1 << 3)
 FUSE_SET_ATTR_ATIME = (1 << 4)
@@ -49,17 +74,50 @@ FUSE_SET_ATTR_MTIME_NOW = (1 << 8)
 SYSCALLS = {}
 
 
-Context = namedtuple('Context', ['mount_path', 'fds', 'scandirs'])
+Context = namedtuple('Context', ['mount_path', 'fds', 'scandirs',
+                                 'read_buffer', 'write_buffer',
+                                 'drop_caches'])
+
+
+class Buffer:
+    """Buffer reused by subsequent syscalls instead of allocating new one
+    for each call. It grows, in powers of 2, to fit the largest request.
+    """
+
+    def __init__(self):
+        self._view = memoryview(bytearray())
+
+    def get(self, size: int) -> memoryview:
+        if size > len(self._view):
+            self._view = memoryview(bytearray(1 << (size - 1).bit_length()))
+        return self._view[:size]
 
 
 class Path(str):
     def __new__(cls, ctx: Context, rel_path: str) -> str:
-        return os.path.join(ctx.mount_path, rel_path)
+        # recorded paths are always relative so there is no need for
+        # os.path.join handling of absolute ones
+        return ctx.mount_path + '/' + rel_path
+
+
+def _keep(_: Context, val):
+    return val
+
+
+def _converter(annotation) -> Callable:
+    if annotation is inspect.Parameter.empty:
+        return _keep
+    elif annotation is Path:
+        return Path
+
+    def convert(_: Context, val):
+        return val if isinstance(val, annotation) else annotation(val)
+
+    return convert
 
 
 def syscall(fun: Callable[..., Optional[int]]) -> Callable[..., int]:
     signature = inspect.signature(fun)
-    parameters = signature.parameters
 
     if signature.return_annotation is int:
         measure_time = False
@@ -67,29 +125,37 @@ def syscall(fun: Callable[..., Optional[int]]) -> Callable[..., int]:
         measure_time = True
         signature = signature.replace(return_annotation=int)
 
+    # Converters for arguments following context are resolved once, here,
+    # instead of binding arguments to signature on every call
+    converters = tuple(_converter(param.annotation)
+                       for param in islice(signature.parameters.values(),
+                                           1, None))
+
+    def convert(ctx: Context, *args) -> tuple:
+        if len(args) != len(converters):
+            raise TypeError('{}() takes {} arguments but {} were given'
+                            ''.format(fun.__name__, len(converters),
+                                      len(args)))
+
+        return (ctx,) + tuple(converter(ctx, val) for converter, val
+                              in zip(converters, args))
+
+    if measure_time:
+        def call(*converted_args) -> int:
+            start = monotonic_ns()
+            fun(*converted_args)
+            return monotonic_ns() - start
+    else:
+        call = fun
+
     @wraps(fun)
-    def wrapper(ctx: Context, *args, **kwargs):
-        bound_arguments = signature.bind(ctx, *args, **kwargs)
-        arguments = bound_arguments.arguments
-        for arg, val in arguments.items():
-            annotation = parameters[arg].annotation
-            if annotation is inspect.Parameter.empty:
-                continue
-            elif annotation is Path:
-                arguments[arg] = Path(ctx, val)
-            elif not isinstance(val, annotation):
-                arguments[arg] = annotation(val)
-
-        converted_args = bound_arguments.args
-        converted_kwargs = bound_arguments.kwargs
-
-        if measure_time:
-            start = time_ns()
-            fun(*converted_args, **converted_kwargs)
-            return time_ns() - start
-        else:
-            return fun(*converted_args, **converted_kwargs)
+    def wrapper(ctx: Context, *args):
+        return call(*convert(ctx, *args))
 
+    # Allows to convert arguments once, ahead of replay, and then only call
+    # syscall with them (see `compile_syscalls`)
+    wrapper.convert = convert
+    wrapper.call = call
     wrapper.__signature__ = signature
     SYSCALLS[fun.__name__] = wrapper
     return wrapper
@@ -106,8 +172,19 @@ def posix_open(ctx: Context, path: Path, flags: int, handle_id: int) -> None:
 
 
 @syscall
-def posix_release(ctx: Context, handle_id: int) -> None:
-    os.close(ctx.fds.pop(handle_id))
+def posix_release(ctx: Context, handle_id: int) -> int:
+    fd = ctx.fds[handle_id]
+    ctx.fds[handle_id] = -1
+    if ctx.drop_caches:
+        # evict file pages so that they will not be served from page cache
+        # to subsequent calls. Eviction is best effort (not every filesystem
+        # supports it) and must not prevent fd from being closed below.
+        with suppress(OSError):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    start = monotonic_ns()
+    os.close(fd)
+    return monotonic_ns() - start
 
 
 @syscall
@@ -170,22 +247,22 @@ def posix_listxattr(_: Context, path: Path) -> None:
 @syscall
 def posix_read(ctx: Context, handle_id: int, size: int, offset: int) -> int:
     fd = ctx.fds[handle_id]
-    os.lseek(fd, offset, os.SEEK_SET)
+    buffers = (ctx.read_buffer.get(size),)
 
-    start = time_ns()
-    os.read(fd, size)
-    return time_ns() - start
+    start = monotonic_ns()
+    preadv(fd, buffers, offset)
+    return monotonic_ns() - start
 
 
 @syscall
 def posix_write(ctx: Context, handle_id: int, size: int, offset: int) -> int:
     fd = ctx.fds[handle_id]
-    os.lseek(fd, offset, os.SEEK_SET)
-    content = bytes(size)
+    # write buffer is never written to so it always holds zeros
+    content = ctx.write_buffer.get(size)
 
-    start = time_ns()
-    os.write(fd, content)
-    return time_ns() - start
+    start = monotonic_ns()
+    os.pwrite(fd, content, offset)
+    return monotonic_ns() - start
 
 
 @syscall
@@ -213,20 +290,17 @@ def posix_readdir(ctx: Context, path: Path, offset: int, size: int) -> int:
     else:
         iterator = ctx.scandirs[path][offset].pop()
 
-    new_offset = offset + (size if size < 128 else 128)
-    start = time_ns()
-    try:
-        for _ in range(offset, new_offset):
-            next(iterator)
-    except StopIteration:
-        return time_ns() - start
-    else:
-        end = time_ns()
+    entries_num = size if size < 128 else 128
+    start = monotonic_ns()
+    # entries are pulled in C by islice instead of one next() call each
+    entries_read = len(list(islice(iterator, entries_num)))
+    end = monotonic_ns()
+    if entries_read == entries_num:
         (ctx.scandirs
          .setdefault(path, {})
-         .setdefault(new_offset, deque())
+         .setdefault(offset + entries_num, deque())
          .append(iterator))
-        return end - start
+    return end - start
 
 
 IO_ENTRY_FIELDS = ['timestamp', 'op', 'duration', 'uuid',
@@ -239,8 +313,28 @@ IO_ENTRY_FIELDS_NUM = len(IO_ENTRY_FIELDS)
 File = namedtuple('File', ['path', 'type', 'size'])
 
 
-class IOEntry(namedtuple('IOEntry', IO_ENTRY_FIELDS)):
-    __slots__ = ()
+class IOEntry:
+    # Plain class with slots instead of namedtuple as entries are created
+    # for every trace line and such objects are faster both to create and
+    # to access fields of (there is no need for tuple behaviour)
+    __slots__ = IO_ENTRY_FIELDS
+
+    def __init__(self, timestamp: int, op: str, duration: int, uuid: str,
+                 handle_id: int, retries: str, arg0: str, arg1: str,
+                 arg2: str, arg3: str, arg4: str, arg5: str, arg6: str):
+        self.timestamp = timestamp
+        self.op = op
+        self.duration = duration
+        self.uuid = uuid
+        self.handle_id = handle_id
+        self.retries = retries
+        self.arg0 = arg0
+        self.arg1 = arg1
+        self.arg2 = arg2
+        self.arg3 = arg3
+        self.arg4 = arg4
+        self.arg5 = arg5
+        self.arg6 = arg6
 
     @classmethod
     def from_str(cls, entry: str) -> 'IOEntry':
@@ -249,15 +343,15 @@ class IOEntry(namedtuple('IOEntry', IO_ENTRY_FIELDS)):
 
         # csv format do not require comma after last argument in line and
         # when there is no last argument (just ,\n) split returns one less
-        # args than expected. In such case add empty string as default value
-        if fields_num == IO_ENTRY_FIELDS_NUM - 1:
-            fields.append('')
-        elif fields_num == IO_ENTRY_FIELDS_NUM:
-            pass
-        else:
-            raise ValueError('Expected {} number of arguments in entry instead '
-                             'of specified {}'.format(IO_ENTRY_FIELDS_NUM,
-                                                      fields_num))
+        # args than expected. In such case add empty string as default value.
+        # Complete entries, the common case, are let through on first check.
+        if fields_num != IO_ENTRY_FIELDS_NUM:
+            if fields_num == IO_ENTRY_FIELDS_NUM - 1:
+                fields.append('')
+            else:
+                raise ValueError('Expected {} number of arguments in entry '
+                                 'instead of specified {}'
+                                 ''.format(IO_ENTRY_FIELDS_NUM, fields_num))
 
         timestamp, op, duration, uuid, handle_id, *args = fields
 
@@ -277,10 +371,12 @@ class IOTraceParser:
 
         self.root_dir = OrderedDict()
         self.initial_files = OrderedDict()
-        self._current_files = OrderedDict()
-        self._env = ChainMap(self._current_files, self.initial_files,
-                             self.root_dir)
+        # every known file (root dir ones, initial ones and ones created
+        # when parsing trace) by uuid, so that finding file takes single
+        # lookup instead of searching above dicts in turn
+        self._env = {}
         self._open_fds = set()
+        self.max_handle_id = -1
         self._pending_lookups = {}
 
     def clean(self):
@@ -305,23 +401,39 @@ class IOTraceParser:
                 sys.exit(1)
             else:
                 self.mount_dir_uuid = mount_entry.uuid
-                self.root_dir[mount_entry.uuid] = File('', 'd', [0, 0])
-
+                mount_dir = File('', 'd', [0, 0])
+                self.root_dir[mount_entry.uuid] = mount_dir
+                self._env[mount_entry.uuid] = mount_dir
+
+            # handlers are bound once per operation instead of once per entry
+            handlers = {}
+            # stats are accumulated in locals and stored once parsing ends,
+            # instead of updating attributes on every entry
+            from_str = IOEntry.from_str
+            io_duration = self.io_duration
+            end_timestamp = self.end_timestamp
             for i, line in enumerate(trace_file, start=3):
                 try:
-                    entry = IOEntry.from_str(line)
-                    operation = getattr(self, entry.op)
+                    entry = from_str(line)
+                    operation = handlers.get(entry.op)
+                    if operation is None:
+                        operation = getattr(self, entry.op)
+                        handlers[entry.op] = operation
                     operation(entry)
                 except Exception:
                     print('Parsing of line {} failed with:'.format(i),
                           file=sys.stderr)
                     traceback.print_exc(file=sys.stderr)
                 else:
-                    self.io_duration += entry.duration
-                    self.end_timestamp = max(self.end_timestamp,
-                                             entry.timestamp + entry.duration)
+                    io_duration += entry.duration
+                    entry_end = entry.timestamp + entry.duration
+                    if entry_end > end_timestamp:
+                        end_timestamp = entry_end
+
+            self.io_duration = io_duration
+            self.end_timestamp = end_timestamp
 
-        self.syscalls.sort(key=lambda x: x[1])
+        self.syscalls.sort(key=itemgetter(1))
         self.start_timestamp = self.syscalls[0][1]
 
     def lookup(self, entry: IOEntry):
@@ -336,15 +448,20 @@ class IOTraceParser:
         path = self._join_path(parent_dir.path, entry.arg0)
 
         if uuid not in self._env:
+            file = File(path, file_type, file_size)
             if entry.uuid == self.mount_dir_uuid:
-                self.root_dir[uuid] = File(path, file_type, file_size)
+                self.root_dir[uuid] = file
             else:
-                self.initial_files[uuid] = File(path, file_type, file_size)
+                self.initial_files[uuid] = file
+            self._env[uuid] = file
 
-        path_lookup = self._take_pending_lookup(parent_dir.path,
-                                                entry.timestamp,
-                                                entry.duration)
-        self._pending_lookups.setdefault(path, []).insert(0, path_lookup)
+        pl_timestamp, pl_duration = self._take_pending_lookup(parent_dir.path,
+                                                              entry.timestamp,
+                                                              entry.duration)
+        # lookup is kept with its end timestamp, which is all that matching
+        # it against subsequent calls needs besides its start
+        self._pending_lookups.setdefault(path, deque()).appendleft(
+            (pl_timestamp, pl_timestamp + pl_duration))
 
     def getattr(self, entry: IOEntry):
         """[getattr] None"""
@@ -386,6 +503,7 @@ class IOTraceParser:
     def open(self, entry: IOEntry):
         """[open] arg-0: flags"""
         self._open_fds.add(entry.handle_id)
+        self.max_handle_id = max(self.max_handle_id, entry.handle_id)
         path = self._get_file(entry.uuid).path
         timestamp, duration = self._take_pending_lookup(path, entry.timestamp,
                                                         entry.duration)
@@ -398,6 +516,7 @@ class IOTraceParser:
         parent_dir.size[0] += 1
 
         self._open_fds.add(entry.handle_id)
+        self.max_handle_id = max(self.max_handle_id, entry.handle_id)
         path = self._join_path(parent_dir.path, entry.arg0)
         self._env[entry.arg1] = File(path, 'f', 0)
         timestamp, duration = self._take_pending_lookup(parent_dir.path,
@@ -542,58 +661,161 @@ class IOTraceParser:
 
     def _take_pending_lookup(self, path: str, timestamp: int,
                              duration: int) -> Tuple[int, int]:
-        pending_lookups_for_path = self._pending_lookups.get(path, [])
-        for pl in pending_lookups_for_path:
-            pl_timestamp, pl_duration = pl
-            if 0 <= timestamp - pl_timestamp - pl_duration <= CTX_SWITCH_DELAY:
-                pending_lookups_for_path.remove(pl)
-                new_lookup = (pl_timestamp, timestamp + duration - pl_timestamp)
+        # pending lookups are kept newest first, so the most recent lookup
+        # made just before given call is matched
+        pending_lookups_for_path = self._pending_lookups.get(path)
+        if not pending_lookups_for_path:
+            return timestamp, duration
+
+        # entries are parsed in timestamp order, so lookups ended more than
+        # CTX_SWITCH_DELAY ago can not match this or any later call and are
+        # dropped (from the oldest end) instead of being scanned over again
+        while pending_lookups_for_path:
+            if timestamp - pending_lookups_for_path[-1][1] <= CTX_SWITCH_DELAY:
                 break
-        else:
-            new_lookup = (timestamp, duration)
+            pending_lookups_for_path.pop()
+
+        for i, (pl_timestamp, pl_end) in enumerate(pending_lookups_for_path):
+            if 0 <= timestamp - pl_end <= CTX_SWITCH_DELAY:
+                del pending_lookups_for_path[i]
+                return pl_timestamp, timestamp + duration - pl_timestamp
 
-        return new_lookup
+        return timestamp, duration
 
     def _get_file(self, uuid: str) -> File:
-        file = self._env.get(uuid)
-        if file:
-            return file
-        else:
-            raise ValueError('unknown file with uuid {}'.format(uuid))
+        try:
+            return self._env[uuid]
+        except KeyError:
+            raise ValueError(
+                'unknown file with uuid {}'.format(uuid)) from None
 
     def _join_path(self, parent_path: str, name: str) -> str:
-        path = os.path.join(parent_path, name)
+        # names are single path components, so plain concatenation gives
+        # the same result as (much slower) os.path.join
+        path = parent_path + '/' + name if parent_path else name
         return self.masked_files.get(path, path)
 
 
-def pairwise(iterable):
-    a, b = tee(iterable)
-    next(b)
-    return zip_longest(a, b)
+def schedule_delays(syscalls) -> array:
+    # delay, in ns, to wait after each syscall before replaying next one,
+    # kept as flat int64 column so replay loop does no tuple arithmetic
+    delays = array('q', bytes(8 * len(syscalls)))
+    for i in range(len(syscalls) - 1):
+        sc, next_sc = syscalls[i], syscalls[i + 1]
+        delay = next_sc[1] - (sc[1] + sc[2])
+        if delay < 0:
+            delay = next_sc[1] - sc[1]
+        delays[i] = delay
+
+    return delays
 
 
-def replay(parser: IOTraceParser, mount_path: str) -> None:
+def _reraise(ex: Exception) -> None:
+    raise ex
+
+
+def compile_syscalls(ctx: Context, syscalls) -> list:
+    # resolve replaying function and convert arguments of every syscall once,
+    # before replay, so that only the call itself is left for replay loop
+    program = []
+    funs = {}
+    for sc in syscalls:
+        try:
+            fun = funs.get(sc[0])
+            if fun is None:
+                fun = funs[sc[0]] = SYSCALLS['posix_{}'.format(sc[0])]
+            program.append((sc[0], fun.call, fun.convert(ctx, *sc[3:])))
+        except Exception as ex:
+            # report failure when replay reaches this syscall
+            program.append((sc[0], _reraise, (ex,)))
+
+    return program
+
+
+def drop_page_cache() -> None:
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as drop_caches:
+            drop_caches.write('3')
+    except Exception as ex:
+        print('Failed to drop page cache due to {!r}'.format(ex),
+              file=sys.stderr)
+
+
+def replay(parser: IOTraceParser, mount_path: str, *,
+           drop_caches: bool = False, cpu: Optional[int] = None,
+           pace: str = PACE_REAL) -> None:
     delays = 0
+    pending_delay = 0
     io_duration = 0
+    failures = []
 
-    ctx = Context(mount_path, {}, {})
-    for sc, next_sc in pairwise(parser.syscalls):
+    if cpu is not None:
+        # pinned before replay structures are allocated so that, on first
+        # touch, they land in memory of NUMA node the cpu belongs to
         try:
-            io_duration += SYSCALLS['posix_{}'.format(sc[0])](ctx, *sc[3:])
+            os.sched_setaffinity(0, {cpu})
         except Exception as ex:
-            print('Failed to execute {} due to {!r}'.format(sc[0], ex),
+            print('Failed to pin replay to cpu {} due to {!r}'.format(cpu, ex),
                   file=sys.stderr)
-            continue
+            sys.exit(1)
+
+    if drop_caches:
+        drop_page_cache()
 
-        if next_sc:
-            delay = next_sc[1] - (sc[1] + sc[2])
-            if delay < 0:
-                delay = next_sc[1] - sc[1]
+    # bind globals used in replay loop to locals to cut per syscall lookups
+    _sleep = sleep
+    _monotonic_ns = monotonic_ns
 
-            delays += delay
-            sleep(delay/10**9)
+    # handle ids are small integers assigned consecutively by Oneclient,
+    # so fds can be kept in flat array indexed by them (-1 if not open)
+    fds = array('i', [-1]) * (parser.max_handle_id + 1)
 
-    prog_duration = io_duration + delays
+    ctx = Context(mount_path, fds, {}, Buffer(), Buffer(), drop_caches)
+    program = compile_syscalls(ctx, parser.syscalls)
+    if pace == PACE_MAX:
+        schedule = repeat(0)
+    else:
+        schedule = schedule_delays(parser.syscalls)
+
+    replay_start = monotonic_ns()
+    for (op, call, args), delay in zip(program, schedule):
+        try:
+            io_duration += call(*args)
+        except Exception as ex:
+            # writing to stderr here would delay subsequent syscalls, so
+            # failures are only recorded and reported after replay. Traceback
+            # is dropped, as only exception itself is reported, so that it
+            # does not keep replay and syscall frames alive until then.
+            failures.append((op, ex.with_traceback(None)))
+            continue
+
+        # sleep(0) still enters kernel, so skip it for back to back calls
+        if delay > 0:
+            pending_delay += delay
+            if pending_delay >= MIN_SLEEP_DELAY:
+                # sleep usually lasts longer than requested, so overshoot is
+                # carried over (as negative pending delay) and subtracted
+                # from following delays instead of accumulating as drift
+                sleep_start = _monotonic_ns()
+                _sleep(pending_delay / 1e9)
+                slept = _monotonic_ns() - sleep_start
+                pending_delay -= slept
+                # only time actually slept counts to program duration, not
+                # delays left pending (never slept) at the end of replay
+                delays += slept
+    replay_end = monotonic_ns()
+
+    for op, ex in failures:
+        print('Failed to execute {} due to {!r}'.format(op, ex),
+              file=sys.stderr)
+
+    if pace == PACE_MAX:
+        # there are no delays to add up when syscalls are issued back to
+        # back, so duration of such replay is measured as a whole instead
+        prog_duration = replay_end - replay_start
+    else:
+        prog_duration = io_duration + delays
     prev_prog_duration = parser.end_timestamp - parser.start_timestamp
 
     overhead = io_duration / prog_duration
@@ -612,23 +834,30 @@ def create_env(initial_files: Dict[str, File], mount_path: str) -> None:
     # first pass to create initial files and directories
     for file in initial_files.values():
         path = os.path.join(mount_path, file.path)
-        if not os.path.exists(path):
-            try:
-                if file.type == 'f':
-                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        # already existing files are left as they are, which is detected by
+        # create itself instead of checking for their existence beforehand
+        try:
+            if file.type == 'f':
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+                try:
                     os.truncate(fd, file.size)
-                elif file.type == 'd':
-                    os.mkdir(path)
-            except Exception as ex:
-                print('Failed to create {} due to {!r}'.format(path, ex))
-                sys.exit(1)
+                finally:
+                    os.close(fd)
+            elif file.type == 'd':
+                os.mkdir(path)
+        except FileExistsError:
+            pass
+        except Exception as ex:
+            print('Failed to create {} due to {!r}'.format(path, ex))
+            sys.exit(1)
 
     # second pass to create dummy files in directories (for readdir)
     for file in initial_files.values():
         if file.type == 'd':
             dir_path = os.path.join(mount_path, file.path)
             try:
-                dir_content = os.listdir(dir_path)
+                # set, as every generated name is checked against it
+                dir_content = set(os.listdir(dir_path))
                 files_to_create = max(0, file.size[1] - len(dir_content))
                 for _ in range(files_to_create):
                     file_name = str(uuid4())
@@ -665,73 +894,136 @@ def print_env_report(syscalls, initial_files: Dict[str, File]) -> None:
                         size=file.size if file.type == 'f' else 0,
                         path=file.path))
 
+    # report lines of all sections are gathered in single pass over syscalls
+    created_files = []
+    removed_files = []
+    renamed_files = []
+    for sc in syscalls:
+        op = sc[0]
+        if op in {'mknod', 'create'}:
+            created_files.append('  {:^11}| {}'.format('file', sc[3]))
+        elif op == 'mkdir':
+            created_files.append('  {:^11}| {}'.format('dir', sc[3]))
+        elif op in {'unlink', 'rmdir'}:
+            removed_files.append('  {}'.format(sc[3]))
+        elif op == 'rename':
+            renamed_files.append('  {} -> {}'.format(sc[3], sc[4]))
+
     print('\n', horizontal_line,
           '\n\n{title:^{width}}\n'.format(title='CREATED FILES', width=width),
           '\n   File Type | Path\n',
           table_line, sep='')
-    for sc in syscalls:
-        if sc[0] in ('mknod', 'create'):
-            file_type = 'file'
-        elif sc[0] == 'mkdir':
-            file_type = 'dir'
-        else:
-            continue
-
-        print('  {:^11}| {}'.format(file_type, sc[3]))
+    for line in created_files:
+        print(line)
 
     print('\n', horizontal_line,
           '\n\n{title:^{width}}\n'.format(title='REMOVED FILES', width=width),
           sep='')
-    for sc in syscalls:
-        if sc[0] in ('unlink', 'rmdir)'):
-            print('  {}'.format(sc[3]))
+    for line in removed_files:
+        print(line)
 
     print('\n', horizontal_line,
           '\n\n{title:^{width}}\n'.format(title='RENAMED FILES', width=width),
           sep='')
-    for sc in syscalls:
-        if sc[0] == 'rename':
-            print('  {} -> {}'.format(sc[3], sc[4]))
+    for line in renamed_files:
+        print(line)
 
     print('\n\n', horizontal_bold_line, sep='')
 
 
+# Trace is sorted as raw bytes, as only timestamps are ever looked at, so
+# there is no need to decode (and then encode back) whole lines
+def _entry_timestamp(line: bytes) -> int:
+    return int(line.partition(b',')[0])
+
+
+def is_trace_file_sorted(path: str) -> bool:
+    with open(path, 'rb') as trace_file:
+        # skip headers and mount entry
+        trace_file.readline()
+        trace_file.readline()
+
+        prev_timestamp = 0
+        for line in trace_file:
+            timestamp = _entry_timestamp(line)
+            if timestamp < prev_timestamp:
+                return False
+            prev_timestamp = timestamp
+
+    return True
+
+
+def _sort_chunk(chunk_path: str) -> None:
+    with open(chunk_path, 'r+b', buffering=SORT_BUFFER_SIZE) as chunk_file:
+        lines = chunk_file.readlines()
+        lines.sort(key=_entry_timestamp)
+        chunk_file.seek(0)
+        chunk_file.writelines(lines)
+
+
 def sort_trace_file(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
-    key_fun = lambda line: int(line.split(',', maxsplit=1)[0])
+    # sorted trace file is left as is, so that sorting already sorted trace
+    # costs just one read of it instead of external sort and full rewrite
+    if is_trace_file_sorted(path):
+        return
 
-    with TemporaryDirectory() as tmpdir, open(path, 'r+') as trace_file:
-        chunks = []
+    key_fun = _entry_timestamp
 
+    with open(path, 'r+b', buffering=SORT_BUFFER_SIZE) as trace_file:
         headers = trace_file.readline()
         mount_entry = trace_file.readline()
         input_iterator = iter(trace_file)
 
-        while True:
-            current_chunk = list(islice(input_iterator, chunk_size))
-            if not current_chunk:
-                break
+        current_chunk = list(islice(input_iterator, chunk_size))
+        next_chunk = list(islice(input_iterator, chunk_size))
 
+        # trace fitting in single chunk is sorted in memory and written
+        # straight back, without going through temporary chunk file
+        if not next_chunk:
             current_chunk.sort(key=key_fun)
+            trace_file.seek(0)
+            trace_file.write(headers)
+            trace_file.write(mount_entry)
+            trace_file.writelines(current_chunk)
+            return
+
+        with TemporaryDirectory() as tmpdir:
+            chunk_paths = []
+
+            while current_chunk:
+                chunk_path = os.path.join(tmpdir,
+                                          'chunk{}'.format(len(chunk_paths)))
+                with open(chunk_path, 'wb',
+                          buffering=SORT_BUFFER_SIZE) as chunk_file:
+                    chunk_file.writelines(current_chunk)
+                chunk_paths.append(chunk_path)
 
-            output_chunk_path = os.path.join(tmpdir,
-                                             'chunk{}'.format(len(chunks)))
-            output_chunk = open(output_chunk_path, 'w+')
-            output_chunk.writelines(current_chunk)
-            output_chunk.flush()
-            output_chunk.seek(0)
-            chunks.append(output_chunk)
+                current_chunk = next_chunk
+                next_chunk = list(islice(input_iterator, chunk_size))
 
-        trace_file.seek(0)
-        trace_file.write(headers)
-        trace_file.write(mount_entry)
-        trace_file.writelines(heapq.merge(*chunks, key=key_fun))
+            # chunks are independent from each other so they are sorted in
+            # parallel by worker processes
+            with Pool(min(len(chunk_paths), os.cpu_count() or 1)) as pool:
+                pool.map(_sort_chunk, chunk_paths)
 
-        for output_chunk in chunks:
-            with suppress(Exception):
-                output_chunk.close()
+            # all chunks are open at once when merging, so they use default
+            # sized buffers to keep memory usage independent of their number
+            chunks = [open(chunk_path, 'rb') for chunk_path in chunk_paths]
+
+            trace_file.seek(0)
+            trace_file.write(headers)
+            trace_file.write(mount_entry)
+            trace_file.writelines(heapq.merge(*chunks, key=key_fun))
+
+            for output_chunk in chunks:
+                with suppress(Exception):
+                    output_chunk.close()
 
 
 def main():
+    # needed by worker processes of trace sort in pyinstaller built binary
+    freeze_support()
+
     parser = argparse.ArgumentParser(prog='ioreplay',
                                      description='Replay recorded activities '
                                                  'performed using Oneclient')
@@ -775,6 +1067,24 @@ def main():
                         action='store_true',
                         help='If specified, alongside `-m`, recorded system '
                              'calls will be replayed')
+    parser.add_argument('--drop-caches',
+                        action='store_true',
+                        help='If specified page cache will be dropped before '
+                             'replay (requires root privileges) and pages of '
+                             'every file will be evicted from it on release, '
+                             'so that replayed calls are not served from '
+                             'cache warmed up by previous ones')
+    parser.add_argument('--pace',
+                        choices=[PACE_REAL, PACE_MAX],
+                        default=PACE_REAL,
+                        help='Pacing of replayed system calls: `real` '
+                             '(default) reproduces recorded delays between '
+                             'them, `max` replays them as fast as possible')
+    parser.add_argument('--cpu',
+                        type=int,
+                        metavar='N',
+                        help='If specified replay will be pinned to cpu N to '
+                             'avoid jitter caused by migrations between cpus')
     args = parser.parse_args()
 
     if args.sort_trace:
@@ -785,14 +1095,22 @@ def main():
     parser.parse(args.io_trace_path)
 
     if args.syscalls:
-        pprint(parser.syscalls, width=100)
+        # one syscall per line, as pprint lays them out, but without its
+        # (much slower) per-item width calculations. Lines are streamed as
+        # they are formatted instead of joining whole listing beforehand.
+        syscall_reprs = map(repr, parser.syscalls)
+        sys.stdout.write('[')
+        sys.stdout.write(next(syscall_reprs, ''))
+        sys.stdout.writelines(',\n ' + sc_repr for sc_repr in syscall_reprs)
+        sys.stdout.write(']\n')
     if args.env_report:
         print_env_report(parser.syscalls, parser.initial_files)
     if args.mount_path:
         if args.create_env:
             create_env(parser.initial_files, args.mount_path)
         if args.run:
-            replay(parser, args.mount_path)
+            replay(parser, args.mount_path, drop_caches=args.drop_caches,
+                   cpu=args.cpu, pace=args.pace)
 
 
 if __name__ == '__main__':